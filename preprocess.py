@@ -0,0 +1,671 @@
+#!/usr/bin/env python3
+"""Convert a directory tree of DICOM files into the PNG + JSON layout the
+web viewer serves.
+
+The input is typically a disc-recovery dump: thousands of files with no
+reliable naming, some damaged, some not DICOM at all.  Each readable file is
+windowed to an 8-bit greyscale slice, grouped by study/series UID, written
+out as ``slice_NNNN.png`` under ``viewer/data/``, and indexed in
+``metadata.json``.  Plain-text radiology reports found in ``data/reports``
+are matched to studies by exam description.
+
+Usage::
+
+    python preprocess.py
+"""
+
+import concurrent.futures
+import functools
+import gc
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import tempfile
+import threading
+from pathlib import Path
+
+import numpy as np
+import pydicom
+from PIL import Image
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+try:
+    import imagecodecs
+except ImportError:
+    imagecodecs = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+DICOM_DIR = Path("data/dicom")
+REPORTS_DIR = Path("data/reports")
+OUTPUT_DIR = Path("viewer/data")
+# Staged slices + metadata from previous runs, so re-running after adding a
+# few files only parses the new ones.
+CACHE_DIR = OUTPUT_DIR / ".cache"
+
+# PNG is lossless at every level; level 1 encodes several times faster than
+# the exhaustive search optimize=True runs, for a small size penalty.
+PNG_COMPRESS_LEVEL = int(os.environ.get("MRI_VIEWER_PNG_LEVEL", "1"))
+
+# Every element the pipeline reads.  Restricting dcmread to these lets
+# pydicom skip decoding private sequences and other bulky elements, which
+# dominate parse time on scanner exports.
+_WANTED_TAGS = (
+    "PatientName",
+    "PatientID",
+    "PatientBirthDate",
+    "PatientSex",
+    "StudyDate",
+    "StudyTime",
+    "StudyDescription",
+    "StudyInstanceUID",
+    "SeriesDescription",
+    "SeriesInstanceUID",
+    "SeriesNumber",
+    "InstanceNumber",
+    "SliceLocation",
+    "Modality",
+    "InstitutionName",
+    "ReferringPhysicianName",
+    "AccessionNumber",
+    "BodyPartExamined",
+    "Rows",
+    "Columns",
+    "WindowCenter",
+    "WindowWidth",
+    "RescaleSlope",
+    "RescaleIntercept",
+    # Needed by pydicom to interpret PixelData.
+    "BitsAllocated",
+    "BitsStored",
+    "HighBit",
+    "PixelRepresentation",
+    "SamplesPerPixel",
+    "PhotometricInterpretation",
+    "PlanarConfiguration",
+    "NumberOfFrames",
+    "PixelData",
+)
+
+
+def json_bytes(obj, indent=False):
+    """Serialize *obj* to JSON bytes, via orjson when available.
+
+    orjson is several times faster than the stdlib encoder and handles
+    numpy scalars natively; ``json.loads`` accepts the bytes either way.
+    """
+    if orjson is not None:
+        option = orjson.OPT_SERIALIZE_NUMPY
+        if indent:
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(obj, option=option)
+    return json.dumps(obj, indent=2 if indent else None).encode("utf-8")
+
+
+# The safe_* helpers run ~20 times per file, so the common cases (None,
+# exact builtin types, and pydicom's int/float-derived IS/DS values) are
+# handled without touching the exception machinery; only genuinely odd
+# values fall through to the guarded conversion.
+
+
+def safe_str(val):
+    """Coerce a pydicom element value (PersonName, MultiValue, ...) to str."""
+    if val is None:
+        return ""
+    if type(val) is str:
+        return val.strip()
+    try:
+        return str(val).strip()
+    except Exception:
+        return ""
+
+
+def safe_int(val, default=0):
+    """Coerce a pydicom element value to int, falling back to *default*."""
+    if type(val) is int:
+        return val
+    if val is None:
+        return default
+    try:
+        # Exception-free for pydicom IS values, which derive from int.
+        return int(val)
+    except (TypeError, ValueError):
+        return default
+
+
+def safe_float(val, default=0.0):
+    """Coerce a pydicom element value to float, falling back to *default*."""
+    if type(val) is float:
+        return val
+    if val is None:
+        return default
+    try:
+        # Exception-free for pydicom DS values, which derive from float.
+        return float(val)
+    except (TypeError, ValueError):
+        return default
+
+
+# Standard presentation windows by modality.  Files from these modalities
+# that carry no window of their own get the constant instead of paying for
+# a percentile scan of the slice.
+_DEFAULT_WINDOWS = {
+    "CT": (40.0, 80.0),
+    "MR": (500.0, 1000.0),
+    "CR": (2048.0, 4096.0),
+    "DX": (2048.0, 4096.0),
+}
+
+
+def get_default_window(pixel_array, modality):
+    """Pick a (center, width) window for files that do not carry one.
+
+    Known modalities get their standard window; everything else falls back
+    to a percentile stretch over the nonzero pixels so air/padding does not
+    skew the range.
+    """
+    default = _DEFAULT_WINDOWS.get(modality)
+    if default is not None:
+        return default
+    nonzero = pixel_array[pixel_array > 0]
+    if nonzero.size == 0:
+        return 128.0, 256.0
+    # Both percentiles via one O(n) introselect instead of np.percentile's
+    # full sort; nonzero is already a private copy, so partition in place.
+    n = nonzero.size
+    k5 = int(0.05 * n)
+    k95 = min(int(0.95 * n), n - 1)
+    nonzero.partition([k5, k95])
+    p5 = float(nonzero[k5])
+    p95 = float(nonzero[k95])
+    center = (p5 + p95) / 2.0
+    width = max(p95 - p5, 1.0)
+    return center, width
+
+
+if numba is not None:
+
+    @numba.njit(
+        [
+            "void(u1[:, ::1], f4, f4, f4, f4, f4, u1[:, ::1])",
+            "void(i2[:, ::1], f4, f4, f4, f4, f4, u1[:, ::1])",
+            "void(u2[:, ::1], f4, f4, f4, f4, f4, u1[:, ::1])",
+            "void(f4[:, ::1], f4, f4, f4, f4, f4, u1[:, ::1])",
+        ],
+        cache=True,
+        fastmath=True,
+    )
+    def _window_kernel(pixels, slope, intercept, img_min, img_max, inv_range, out):
+        # Fused rescale/clip/scale/cast: one read of the stored pixels and
+        # one uint8 write, instead of separate full-array passes for the
+        # slope/intercept, clip, scale and cast steps.  Single-threaded on
+        # purpose: the process pool already saturates every core, and
+        # numba's default threading layer is not fork-safe — a parallel
+        # kernel initialized before the fork hangs the parent at exit.
+        for i in range(pixels.shape[0]):
+            for j in range(pixels.shape[1]):
+                v = pixels[i, j] * slope + intercept
+                if v < img_min:
+                    v = img_min
+                elif v > img_max:
+                    v = img_max
+                out[i, j] = np.uint8((v - img_min) * inv_range * 255.0)
+
+else:
+    _window_kernel = None
+
+_KERNEL_DTYPES = (np.uint8, np.int16, np.uint16, np.float32)
+
+
+def apply_windowing(pixel_array, window_center, window_width, slope=1.0, intercept=0.0):
+    """Map a pixel array to uint8 greyscale via a linear window.
+
+    The rescale slope/intercept is fused into the same pass, so callers can
+    hand over ``ds.pixel_array`` in its stored integer dtype and no float
+    copy of the slice is ever materialized.  The NumPy fallback works in
+    place and may scribble on a float32 input; callers pass throwaway
+    arrays.
+    """
+    img_min = window_center - window_width / 2.0
+    img_max = window_center + window_width / 2.0
+    if (
+        _window_kernel is not None
+        and pixel_array.ndim == 2
+        and pixel_array.dtype in _KERNEL_DTYPES
+    ):
+        out = np.empty(pixel_array.shape, np.uint8)
+        _window_kernel(
+            np.ascontiguousarray(pixel_array),
+            slope,
+            intercept,
+            img_min,
+            img_max,
+            1.0 / (img_max - img_min),
+            out,
+        )
+        return out
+    # Fallback: same arithmetic with every step in place, so the only
+    # allocations are the float working copy (when the input is integer)
+    # and the uint8 result, instead of a fresh temporary per operation.
+    arr = pixel_array.astype(np.float32, copy=False)
+    if slope != 1.0 or intercept != 0.0:
+        arr *= np.float32(slope)
+        arr += np.float32(intercept)
+    np.clip(arr, img_min, img_max, out=arr)
+    arr -= np.float32(img_min)
+    arr *= np.float32(255.0 / (img_max - img_min))
+    out = np.empty(arr.shape, np.uint8)
+    np.copyto(out, arr, casting="unsafe")
+    return out
+
+
+def process_dicom_file(task, cache_dir):
+    """Read one DICOM file and stage its windowed slice for the organize pass.
+
+    Runs in a worker process.  *task* is ``(fpath, cache_key)``; the uint8
+    slice is dumped to *cache_dir* with ``np.save`` under a name derived
+    from the cache key, and ``(cache_key, metadata, npy_name)`` travels back
+    — only plain picklable values cross the process boundary, never the
+    pydicom ``FileDataset``.  Unreadable, pixel-less or fully black
+    (damaged) files yield ``(cache_key, None, None)`` so they can be
+    remembered and skipped next run.
+    """
+    fpath, cache_key = task
+    try:
+        ds = pydicom.dcmread(str(fpath), force=True, specific_tags=list(_WANTED_TAGS))
+    except Exception:
+        return cache_key, None, None
+    if "PixelData" not in ds:
+        return cache_key, None, None
+    try:
+        pixels = ds.pixel_array
+    except Exception:
+        return cache_key, None, None
+    # Multi-frame (cine) files decode to 3D stacks the PNG writers cannot
+    # take; reject them like other unusable files rather than corrupting
+    # or aborting the run downstream.
+    if pixels.ndim != 2:
+        return cache_key, None, None
+    # any() short-circuits at the first nonzero pixel, so intact slices
+    # cost a handful of elements; np.all(pixels == 0) scanned (and
+    # allocated) a full boolean array either way.
+    if not pixels.any():
+        return cache_key, None, None
+
+    slope = safe_float(getattr(ds, "RescaleSlope", None), 1.0)
+    intercept = safe_float(getattr(ds, "RescaleIntercept", None), 0.0)
+    modality = safe_str(getattr(ds, "Modality", ""))
+    wc = getattr(ds, "WindowCenter", None)
+    ww = getattr(ds, "WindowWidth", None)
+    if wc is not None and ww is not None:
+        # Multi-valued windows are common; the first pair is the default.
+        if isinstance(wc, pydicom.multival.MultiValue):
+            wc = wc[0]
+        if isinstance(ww, pydicom.multival.MultiValue):
+            ww = ww[0]
+        wc = safe_float(wc, 0.0)
+        ww = safe_float(ww, 0.0)
+    if wc is None or ww is None or ww <= 0:
+        # The percentile fallback needs real (rescaled) values, so only
+        # this path pays for a float copy of the slice.
+        rescaled = pixels.astype(np.float32, copy=False)
+        if slope != 1.0 or intercept != 0.0:
+            rescaled = rescaled * np.float32(slope) + np.float32(intercept)
+        wc, ww = get_default_window(rescaled, modality)
+        img_data = apply_windowing(rescaled, wc, ww)
+    else:
+        img_data = apply_windowing(pixels, wc, ww, slope, intercept)
+
+    metadata = {
+        "patientName": safe_str(getattr(ds, "PatientName", "")),
+        "patientID": safe_str(getattr(ds, "PatientID", "")),
+        "patientBirthDate": safe_str(getattr(ds, "PatientBirthDate", "")),
+        "patientSex": safe_str(getattr(ds, "PatientSex", "")),
+        "studyDate": safe_str(getattr(ds, "StudyDate", "")),
+        "studyTime": safe_str(getattr(ds, "StudyTime", "")),
+        "studyDescription": safe_str(getattr(ds, "StudyDescription", "")),
+        "studyInstanceUID": safe_str(getattr(ds, "StudyInstanceUID", "")),
+        "seriesDescription": safe_str(getattr(ds, "SeriesDescription", "")),
+        "seriesInstanceUID": safe_str(getattr(ds, "SeriesInstanceUID", "")),
+        "seriesNumber": safe_int(getattr(ds, "SeriesNumber", None), 0),
+        "instanceNumber": safe_int(getattr(ds, "InstanceNumber", None), 0),
+        "sliceLocation": safe_float(getattr(ds, "SliceLocation", None), 0.0),
+        "modality": modality,
+        "institutionName": safe_str(getattr(ds, "InstitutionName", "")),
+        "referringPhysician": safe_str(getattr(ds, "ReferringPhysicianName", "")),
+        "accessionNumber": safe_str(getattr(ds, "AccessionNumber", "")),
+        "bodyPartExamined": safe_str(getattr(ds, "BodyPartExamined", "")),
+        "rows": safe_int(getattr(ds, "Rows", None), 0),
+        "columns": safe_int(getattr(ds, "Columns", None), 0),
+        "windowCenter": float(wc),
+        "windowWidth": float(ww),
+    }
+    if not metadata["studyInstanceUID"] or not metadata["seriesInstanceUID"]:
+        return cache_key, None, None
+
+    # Stage via a temp file + rename so a crash cannot leave a truncated
+    # .npy in the cache.
+    npy_name = hashlib.blake2b(cache_key.encode("utf-8"), digest_size=16).hexdigest() + ".npy"
+    fd, tmp_path = tempfile.mkstemp(suffix=".npy.tmp", dir=cache_dir)
+    with os.fdopen(fd, "wb") as f:
+        np.save(f, img_data)
+    os.replace(tmp_path, os.path.join(cache_dir, npy_name))
+    return cache_key, metadata, npy_name
+
+
+# Per-thread reusable PIL image for the fallback encoder: slices within a
+# series share a shape, so one buffer serves the whole run instead of a
+# fresh Image + malloc per slice.  Thread-local because PNG writes happen
+# on a pool.
+_pil_buffer = threading.local()
+
+
+def _pil_save(img_data, png_path):
+    cached = getattr(_pil_buffer, "entry", None)
+    if cached is None or cached[0] != img_data.shape:
+        buf = np.empty(img_data.shape, np.uint8)
+        im = Image.frombuffer(
+            "L", (img_data.shape[1], img_data.shape[0]), buf, "raw", "L", 0, 1
+        )
+        cached = _pil_buffer.entry = (img_data.shape, buf, im)
+    _shape, buf, im = cached
+    np.copyto(buf, img_data)
+    im.save(str(png_path), format="PNG", compress_level=PNG_COMPRESS_LEVEL)
+
+
+def write_png(img_data, png_path):
+    """Encode a uint8 greyscale slice to PNG.
+
+    Prefers imagecodecs' libpng binding, which encodes grayscale arrays a
+    few times faster than PIL's writer; falls back to PIL when the optional
+    dependency is missing.
+    """
+    if imagecodecs is not None:
+        buf = imagecodecs.png_encode(img_data, level=PNG_COMPRESS_LEVEL)
+        with open(png_path, "wb") as f:
+            f.write(buf)
+    else:
+        _pil_save(img_data, png_path)
+
+
+_EXAM_RE = re.compile(r"^\s*EXAM\s*:\s*(.+)$", re.IGNORECASE | re.MULTILINE)
+
+
+def load_reports():
+    """Load radiology report text files keyed by their EXAM: line."""
+    reports = {}
+    if not REPORTS_DIR.is_dir():
+        return reports
+    for txt_file in sorted(REPORTS_DIR.glob("*.txt")):
+        content = txt_file.read_text(errors="ignore")
+        # One regex search instead of splitting the whole report into a
+        # list of lines just to find the first EXAM: header.
+        m = _EXAM_RE.search(content)
+        exam = m.group(1).strip().upper() if m else ""
+        reports[exam or txt_file.stem.upper()] = content
+    return reports
+
+
+def find_report(study_description, reports):
+    """Return the report whose exam line best matches a study description."""
+    desc = study_description.upper()
+    if not desc:
+        return ""
+    for exam, content in reports.items():
+        if exam and (exam in desc or desc in exam):
+            return content
+    return ""
+
+
+# Extensions that are never DICOM; skipped without even a stat call.
+_SKIP_SUFFIXES = {".txt", ".log", ".htm", ".html", ".exe", ".dll", ".ini", ".db"}
+
+
+def _iter_files(dirpath):
+    """Recursively yield ``(Path, size)`` for regular files via os.scandir.
+
+    DirEntry reuses the stat data the directory read already fetched, so
+    this avoids the second per-file stat syscall the old os.walk +
+    Path.stat combination made on every entry.
+    """
+    try:
+        entries = os.scandir(dirpath)
+    except OSError:
+        return
+    with entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                yield from _iter_files(entry.path)
+            elif entry.is_file(follow_symlinks=False):
+                suffix = os.path.splitext(entry.name)[1].lower()
+                if suffix in _SKIP_SUFFIXES or entry.name == ".DS_Store":
+                    continue
+                yield Path(entry.path), entry.stat(follow_symlinks=False).st_size
+
+
+def collect_dicom_files():
+    """Walk DICOM_DIR and return unique DICOM candidate paths.
+
+    Recovery dumps are full of byte-identical duplicates and files that are
+    not DICOM at all.  Checking the DICM magic and hashing the first 4 KB
+    rejects both in microseconds per file, long before pydicom gets
+    involved; duplicates keep whichever path sorts first after the walk.
+    """
+    seen_heads = {}
+    candidates = [fpath for fpath, size in _iter_files(DICOM_DIR) if size >= 132]
+    candidates.sort()
+    dicom_files = []
+    for fpath in candidates:
+        with open(fpath, "rb") as f:
+            head = f.read(4096)
+        if head[128:132] != b"DICM":
+            continue
+        digest = hashlib.blake2b(head, digest_size=16).digest()
+        if digest in seen_heads:
+            continue
+        seen_heads[digest] = fpath
+        dicom_files.append(fpath)
+    return dicom_files
+
+
+def main():
+    dicom_files = collect_dicom_files()
+    print(f"Found {len(dicom_files)} candidate files")
+    OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
+    CACHE_DIR.mkdir(parents=True, exist_ok=True)
+
+    cache_db = sqlite3.connect(OUTPUT_DIR / ".cache.db")
+    cache_db.execute("PRAGMA journal_mode=WAL")
+    cache_db.execute(
+        "CREATE TABLE IF NOT EXISTS slices "
+        "(key TEXT PRIMARY KEY, meta_json TEXT, npy_name TEXT)"
+    )
+    cached = {
+        key: (meta_json, npy_name)
+        for key, meta_json, npy_name in cache_db.execute(
+            "SELECT key, meta_json, npy_name FROM slices"
+        )
+    }
+
+    studies = {}
+
+    def record(meta, npy_path):
+        # Sort keys lead the tuple so the per-series sort below is a plain
+        # C-level tuple comparison with no Python callbacks; the unique
+        # staging path breaks ties before the dict.  Plain dicts instead of
+        # nested defaultdicts: no lambda frame per miss, and the structure
+        # stays picklable.
+        series_map = studies.get(meta["studyInstanceUID"])
+        if series_map is None:
+            series_map = studies[meta["studyInstanceUID"]] = {}
+        images = series_map.get(meta["seriesInstanceUID"])
+        if images is None:
+            images = series_map[meta["seriesInstanceUID"]] = []
+        images.append(
+            (meta["instanceNumber"], meta["sliceLocation"], npy_path, meta)
+        )
+
+    # Replay unchanged files straight from the cache; only new or modified
+    # files (and files remembered as bad) go anywhere near pydicom.
+    todo = []
+    hits = 0
+    for fpath in dicom_files:
+        st = os.stat(fpath)
+        key = f"{fpath}|{st.st_mtime_ns}|{st.st_size}"
+        entry = cached.get(key)
+        if entry is not None:
+            meta_json, npy_name = entry
+            if meta_json is None:
+                # Remembered as unreadable/damaged.
+                continue
+            npy_path = str(CACHE_DIR / npy_name)
+            if os.path.exists(npy_path):
+                record(json.loads(meta_json), npy_path)
+                hits += 1
+                continue
+        todo.append((fpath, key))
+    if hits:
+        print(f"  {hits} files unchanged since last run, replayed from cache")
+
+    # Pass 1: parse + window in worker processes.  Workers stage the uint8
+    # slices in the cache dir so only small dicts travel back; the parent
+    # alone writes to sqlite, in batches.
+    worker = functools.partial(process_dicom_file, cache_dir=str(CACHE_DIR))
+    done = 0
+    pending_rows = []
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=os.cpu_count()
+    ) as executor:
+        for key, meta, npy_name in executor.map(worker, todo, chunksize=16):
+            done += 1
+            if done % 500 == 0:
+                print(f"  parsed {done}/{len(todo)}")
+            pending_rows.append(
+                (key, None if meta is None else json_bytes(meta), npy_name)
+            )
+            if len(pending_rows) >= 100:
+                cache_db.executemany(
+                    "INSERT OR REPLACE INTO slices VALUES (?, ?, ?)", pending_rows
+                )
+                cache_db.commit()
+                pending_rows.clear()
+            if meta is not None:
+                record(meta, str(CACHE_DIR / npy_name))
+    if pending_rows:
+        cache_db.executemany(
+            "INSERT OR REPLACE INTO slices VALUES (?, ?, ?)", pending_rows
+        )
+        cache_db.commit()
+    cache_db.close()
+
+    # Pass 2: now that grouping is known, lay out directories and write
+    # the PNGs.  Encode + write happens on a small thread pool (libz and
+    # os.write release the GIL) so it overlaps loading the next slices;
+    # the semaphore caps how many decoded slices wait in flight.
+    reports = load_reports()
+    metadata = {"studies": []}
+    png_pool = concurrent.futures.ThreadPoolExecutor(max_workers=4)
+    png_slots = threading.BoundedSemaphore(32)
+
+    def write_png_async(img_data, png_path):
+        png_slots.acquire()
+        try:
+            return png_pool.submit(_write_png_release, img_data, png_path)
+        except BaseException:
+            png_slots.release()
+            raise
+
+    def _write_png_release(img_data, png_path):
+        try:
+            write_png(img_data, png_path)
+        finally:
+            png_slots.release()
+
+    for study_uid, series_map in sorted(studies.items()):
+        study_tag = hashlib.blake2b(study_uid.encode("utf-8"), digest_size=4).hexdigest()
+        first_meta = next(iter(series_map.values()))[0][3]
+        study_dirname = f"study_{first_meta['studyDate'] or 'unknown'}_{study_tag}"
+        study_entry = {
+            "id": study_dirname,
+            "patientName": first_meta["patientName"],
+            "patientID": first_meta["patientID"],
+            "patientBirthDate": first_meta["patientBirthDate"],
+            "patientSex": first_meta["patientSex"],
+            "studyDate": first_meta["studyDate"],
+            "studyTime": first_meta["studyTime"],
+            "studyDescription": first_meta["studyDescription"],
+            "institutionName": first_meta["institutionName"],
+            "referringPhysician": first_meta["referringPhysician"],
+            "accessionNumber": first_meta["accessionNumber"],
+            "report": find_report(first_meta["studyDescription"], reports),
+            "series": [],
+        }
+        for series_uid, images in sorted(series_map.items()):
+            images.sort()
+            series_meta = images[0][3]
+            # SeriesNumber alone is not unique (recovery dumps often lack
+            # it entirely, collapsing everything to 0), so a UID-derived
+            # tag keeps distinct series from sharing a directory.
+            series_tag = hashlib.blake2b(
+                series_uid.encode("utf-8"), digest_size=4
+            ).hexdigest()
+            series_dirname = f"series_{series_meta['seriesNumber']:04d}_{series_tag}"
+            series_dir = OUTPUT_DIR / study_dirname / series_dirname
+            series_dir.mkdir(parents=True, exist_ok=True)
+            series_entry = {
+                "seriesNumber": series_meta["seriesNumber"],
+                "seriesDescription": series_meta["seriesDescription"],
+                "modality": series_meta["modality"],
+                "bodyPartExamined": series_meta["bodyPartExamined"],
+                "images": [],
+            }
+            futures = []
+            for idx, (_inst, _loc, npy_path, meta) in enumerate(images):
+                # mmap the staged slice: the encoder faults its pages in
+                # once and nothing is copied into a heap array.
+                img_data = np.load(npy_path, mmap_mode="r")
+                png_path = series_dir / f"slice_{idx:04d}.png"
+                futures.append(write_png_async(img_data, png_path))
+                series_entry["images"].append(
+                    {
+                        "file": str(png_path.relative_to(OUTPUT_DIR)),
+                        "instanceNumber": meta["instanceNumber"],
+                        "sliceLocation": meta["sliceLocation"],
+                        "rows": meta["rows"],
+                        "columns": meta["columns"],
+                        "windowCenter": meta["windowCenter"],
+                        "windowWidth": meta["windowWidth"],
+                    }
+                )
+            # Surface encode/write errors before the series is recorded.
+            for fut in futures:
+                fut.result()
+            study_entry["series"].append(series_entry)
+            # Everything for this series is on disk; drop the slice tuples
+            # so the mmaps (and their pages) can be reclaimed.
+            images.clear()
+        series_map.clear()
+        gc.collect()
+        metadata["studies"].append(study_entry)
+        print(
+            f"Wrote study {study_dirname} "
+            f"({sum(len(s['images']) for s in study_entry['series'])} slices)"
+        )
+    png_pool.shutdown(wait=True)
+
+    with open(OUTPUT_DIR / "metadata.json", "wb") as f:
+        f.write(json_bytes(metadata, indent=True))
+    print(f"Done: {len(metadata['studies'])} studies -> {OUTPUT_DIR}")
+
+
+if __name__ == "__main__":
+    main()